@@ -1,21 +1,92 @@
 import asyncio
+import time
+from collections import OrderedDict
+
 import aioredis
 
 
+class _LocalCache:
+    """
+    Bounded in-process LRU whose entries expire ttl seconds after being stored
+
+    Keys with a read from redis in flight carry a generation that pop and clear_prefix bump,
+    so a read that raced with a write or delete is not stored
+    """
+
+    def __init__(self, maxsize, ttl):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._data = OrderedDict()
+        self._reads = {}
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (value, time.monotonic() + self._ttl)
+        self._data.move_to_end(key)
+        if len(self._data) > self._maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        self._data.pop(key, None)
+        read = self._reads.get(key)
+        if read is not None:
+            read[1] += 1
+
+    def clear_prefix(self, prefix):
+        for key in [k for k in self._data if k.startswith(prefix)]:
+            del self._data[key]
+        for key, read in self._reads.items():
+            if key.startswith(prefix):
+                read[1] += 1
+
+    def begin_read(self, key):
+        read = self._reads.setdefault(key, [0, 0])
+        read[0] += 1
+        return read[1]
+
+    def end_read(self, key, generation, value):
+        read = self._reads[key]
+        read[0] -= 1
+        if not read[0]:
+            del self._reads[key]
+        if value is not None and read[1] == generation:
+            self.set(key, value)
+
+
 class RedisCache:
-    def __init__(self):
+    _scan_count = 1000
+    _use_unlink = True
+
+    def __init__(self, local_cache_size=0, local_cache_ttl=1.0):
+        """
+        :param local_cache_size: Number of values to keep in an in-process cache in front of redis, 0 disables it
+        :param local_cache_ttl: Seconds a locally cached value may be served before going back to redis
+        """
         self._pool = None
+        self._local = _LocalCache(local_cache_size, local_cache_ttl) if local_cache_size else None
+        self._pending_gets = {}
 
-    def connect(self, host, port, minsize=5, maxsize=10, loop=asyncio.get_event_loop()):
+    async def connect(self, host, port, minsize=5, maxsize=10, loop=None):
         """
         Setup a connection pool
         :param host: Redis host
         :param port: Redis port
         :param loop: Event loop
         """
-        self._pool = yield from aioredis.create_pool((host, port), minsize=minsize, maxsize=maxsize, loop=loop)
+        loop = loop or asyncio.get_event_loop()
+        self._pool = await aioredis.create_pool((host, port), minsize=minsize, maxsize=maxsize, loop=loop)
 
-    def set_key(self, key, value, namespace=None, expire=0):
+    async def set_key(self, key, value, namespace=None, expire=0):
         """
         Set a key in a cache.
         :param key: Key name
@@ -24,29 +95,145 @@ class RedisCache:
         :param expire: expiration
         :return:
         """
-        with (yield from self._pool) as redis:
-            if namespace is not None:
-                key = self._get_key(namespace, key)
-            yield from redis.set(key, value, expire=expire)
-
-    def get_key(self, key, namespace=None):
-        with (yield from self._pool) as redis:
-            if namespace is not None:
-                key = self._get_key(namespace, key)
-            return (yield from redis.get(key, encoding='utf-8'))
-
-    def delete(self, key, namespace=None):
-        with (yield from self._pool) as redis:
-            if namespace is not None:
-                key = self._get_key(namespace, key)
-            yield from redis.delete(key)
-
-    def clear_namespace(self, namespace):
-        with (yield from self._pool) as redis:
+        if namespace is not None:
+            key = self._get_key(namespace, key)
+        if self._local is not None:
+            self._local.pop(key)
+        with (await self._pool) as redis:
+            await redis.set(key, value, expire=expire)
+        # again once redis has the new value, for reads that started while it was being written
+        if self._local is not None:
+            self._local.pop(key)
+
+    async def get_key(self, key, namespace=None):
+        if namespace is not None:
+            key = self._get_key(namespace, key)
+        if self._local is None:
+            return await self._batched_get(key)
+        value = self._local.get(key)
+        if value is not None:
+            return value
+        generation = self._local.begin_read(key)
+        value = None
+        try:
+            value = await self._batched_get(key)
+        finally:
+            self._local.end_read(key, generation, value)
+        return value
+
+    async def delete(self, key, namespace=None):
+        if namespace is not None:
+            key = self._get_key(namespace, key)
+        if self._local is not None:
+            self._local.pop(key)
+        with (await self._pool) as redis:
+            await redis.delete(key)
+        if self._local is not None:
+            self._local.pop(key)
+
+    async def clear_namespace(self, namespace):
+        """
+        Delete every key in a namespace.
+        Walks the keyspace with SCAN instead of KEYS so the server is never blocked,
+        and pipelines an UNLINK of each batch on the same connection so the memory is reclaimed in the background.
+        Redis servers older than 4.0 have no UNLINK, so DEL is used instead once one rejects it.
+        :param namespace: Namespace whose keys should be removed
+        :return: Number of keys removed
+        """
+        if self._local is not None:
+            self._local.clear_prefix(namespace)
+        with (await self._pool) as redis:
             pattern = namespace + '*'
-            keys = yield from redis.keys(pattern)
-            if len(keys):
-                yield from redis.delete(*keys)
+            cursor, batches, pending = 0, [], []
+            while True:
+                cursor, keys = await redis.scan(cursor, match=pattern, count=self._scan_count)
+                if keys:
+                    batches.append(keys)
+                    pending.append(self._delete_keys(redis, keys))
+                if not cursor:
+                    break
+            counts = await asyncio.gather(*pending, return_exceptions=True)
+            retry = [keys for keys, count in zip(batches, counts) if self._is_unknown_command(count)]
+            if retry:
+                self._use_unlink = False
+                counts = [count for count in counts if not self._is_unknown_command(count)]
+                counts += await asyncio.gather(*[redis.delete(*keys) for keys in retry], return_exceptions=True)
+            for count in counts:
+                if isinstance(count, Exception):
+                    raise count
+            removed = sum(counts)
+        if self._local is not None:
+            self._local.clear_prefix(namespace)
+        return removed
+
+    def _delete_keys(self, redis, keys):
+        # aioredis 0.x has no unlink command, so it is sent through the raw connection
+        if self._use_unlink:
+            return redis.connection.execute(b'UNLINK', *keys)
+        return redis.delete(*keys)
+
+    @staticmethod
+    def _is_unknown_command(result):
+        return isinstance(result, aioredis.ReplyError) and 'unknown command' in str(result).lower()
+
+    def _batched_get(self, key):
+        """
+        Queue a key for the next MGET.
+        Every get_key issued in the same event loop iteration is answered by a single MGET,
+        and concurrent lookups of the same key share one slot in it.
+        """
+        loop = asyncio.get_event_loop()
+        if not self._pending_gets:
+            loop.call_soon(self._flush_gets)
+        future = loop.create_future()
+        self._pending_gets.setdefault(key, []).append(future)
+        return future
+
+    def _flush_gets(self):
+        pending, self._pending_gets = self._pending_gets, {}
+        task = asyncio.ensure_future(self._mget(pending))
+        task.add_done_callback(lambda _: self._cancel_gets(pending))
+
+    @staticmethod
+    def _cancel_gets(pending):
+        # waiters _mget did not answer, e.g. because its task was cancelled, must not hang
+        for futures in pending.values():
+            for future in futures:
+                future.cancel()
+
+    async def _mget(self, pending):
+        """
+        Answers a batch of get_key calls, each key with its own value or error
+        """
+        keys = list(pending)
+        try:
+            with (await self._pool) as redis:
+                try:
+                    values = await redis.mget(*keys)
+                except Exception:
+                    values = [None] * len(keys)
+                # MGET answers nil where GET raises, e.g. WRONGTYPE for a key holding a list,
+                # so misses are checked again with GETs pipelined on the same connection
+                missing = [key for key, value in zip(keys, values) if value is None]
+                results = dict(zip(keys, values))
+                results.update(zip(missing, await asyncio.gather(*[redis.get(key) for key in missing],
+                                                                 return_exceptions=True)))
+        except Exception as e:
+            results = dict.fromkeys(keys, e)
+        for key, futures in pending.items():
+            value = results[key]
+            if isinstance(value, bytes):
+                try:
+                    value = value.decode('utf-8')
+                except UnicodeDecodeError as e:
+                    value = e
+            for future in futures:
+                if future.done():
+                    continue
+                if isinstance(value, Exception):
+                    future.set_exception(value)
+                else:
+                    future.set_result(value)
 
     def exit(self):
         if self._pool is not None:
@@ -54,4 +241,4 @@ class RedisCache:
 
     @staticmethod
     def _get_key(namespace, key):
-        return namespace + ':' + key
+        return f'{namespace}:{key}'
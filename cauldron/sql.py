@@ -1,14 +1,20 @@
-from asyncio import coroutine
+import asyncio
 from contextlib import contextmanager
-from functools import wraps
+from functools import lru_cache, wraps
+from hashlib import sha1
 from enum import Enum
+from itertools import chain
+from operator import itemgetter
+from uuid import uuid4
+from weakref import WeakKeyDictionary
 import aiopg
 
 from aiopg import create_pool, Pool, Cursor
 
-import psycopg2
+from psycopg2.extras import DictCursor, NamedTupleCursor
 
 _CursorType = Enum('CursorType', 'PLAIN, DICT, NAMEDTUPLE')
+_CURSOR_FACTORIES = {_CursorType.PLAIN: None, _CursorType.DICT: DictCursor, _CursorType.NAMEDTUPLE: NamedTupleCursor}
 
 
 def dict_cursor(func):
@@ -26,9 +32,9 @@ def dict_cursor(func):
     """
 
     @wraps(func)
-    def wrapper(cls, *args, **kwargs):
-        with (yield from cls.get_cursor(_CursorType.DICT)) as c:
-            return (yield from func(cls, c, *args, **kwargs))
+    async def wrapper(cls, *args, **kwargs):
+        with (await cls.get_cursor(_CursorType.DICT)) as c:
+            return await func(cls, c, *args, **kwargs)
 
     return wrapper
 
@@ -48,9 +54,9 @@ def cursor(func):
     """
 
     @wraps(func)
-    def wrapper(cls, *args, **kwargs):
-        with (yield from cls.get_cursor()) as c:
-            return (yield from func(cls, c, *args, **kwargs))
+    async def wrapper(cls, *args, **kwargs):
+        with (await cls.get_cursor()) as c:
+            return await func(cls, c, *args, **kwargs)
 
     return wrapper
 
@@ -70,18 +76,66 @@ def nt_cursor(func):
     """
 
     @wraps(func)
-    def wrapper(cls, *args, **kwargs):
-        with (yield from cls.get_cursor(_CursorType.NAMEDTUPLE)) as c:
-            return (yield from func(cls, c, *args, **kwargs))
+    async def wrapper(cls, *args, **kwargs):
+        with (await cls.get_cursor(_CursorType.NAMEDTUPLE)) as c:
+            return await func(cls, c, *args, **kwargs)
 
     return wrapper
 
 
+class _LazyBegin:
+    """
+    Opens the transaction of a cursor lazily
+
+    BEGIN is sent in the same round-trip as the first statement instead of on its own,
+    and a function that never executes anything does not open a transaction at all.
+    execute and callproc are replaced on the cursor instance instead of wrapping the cursor,
+    so the function still gets the real aiopg cursor
+    """
+
+    def __init__(self, cur):
+        self._cur = cur
+        self._execute = cur.execute
+        self._callproc = cur.callproc
+        self.in_transaction = False
+        cur.execute = self.execute
+        cur.callproc = self.callproc
+
+    async def execute(self, operation, parameters=None, **kwargs):
+        if not self.in_transaction:
+            self.in_transaction = True
+            if isinstance(operation, str):
+                operation = 'BEGIN; ' + operation
+            elif isinstance(operation, bytes):
+                operation = b'BEGIN; ' + operation
+            else:
+                # e.g. psycopg2.sql.Composed, which cannot be prefixed
+                await self._execute('BEGIN')
+        return await self._execute(operation, parameters, **kwargs)
+
+    async def callproc(self, procname, parameters=None, **kwargs):
+        if not self.in_transaction:
+            self.in_transaction = True
+            await self._execute('BEGIN')
+        return await self._callproc(procname, parameters, **kwargs)
+
+    def restore(self):
+        """
+        Puts the cursor's own execute and callproc back
+
+        Returns:
+            whether a transaction was opened
+        """
+        del self._cur.execute
+        del self._cur.callproc
+        return self.in_transaction
+
+
 def transaction(func):
     """
     Provides a transacted cursor which will run in autocommit=false mode
 
-    For any exception the transaction will be rolled back.
+    For any exception the transaction will be rolled back and the exception re-raised.
     Requires that the function being decorated is an instance of a class or object
     that yields a cursor from a get_cursor(cursor_type=CursorType.NAMEDTUPLE) coroutine or provides such an object
     as the first argument in its signature
@@ -91,49 +145,78 @@ def transaction(func):
     """
 
     @wraps(func)
-    def wrapper(cls, *args, **kwargs):
-        with (yield from cls.get_cursor(_CursorType.NAMEDTUPLE)) as c:
+    async def wrapper(cls, *args, **kwargs):
+        with (await cls.get_cursor(_CursorType.NAMEDTUPLE)) as c:
+            lazy_begin = _LazyBegin(c)
             try:
-                yield from c.execute('BEGIN')
-                result = (yield from func(cls, c, *args, **kwargs))
-            except Exception:
-                yield from c.execute('ROLLBACK')
-            else:
-                yield from c.execute('COMMIT')
-                return result
+                result = await func(cls, c, *args, **kwargs)
+            except BaseException:
+                if lazy_begin.restore():
+                    await c.execute('ROLLBACK')
+                raise
+            if lazy_begin.restore():
+                await c.execute('COMMIT')
+            return result
 
     return wrapper
 
 
 class PostgresStore:
     _pool = None
+    _pool_lock = None
+    _inflight_selects = {}
+    _column_types = {}
+    _table_oids = {}
     _connection_params = {}
     _use_pool = None
+    _prepare_statements = False
+    _prepared = WeakKeyDictionary()
     _insert_string = "insert into {} ({}) values ({}) returning *;"
+    _insert_string_no_returning = "insert into {} ({}) values ({});"
+    _bulk_insert_string = "insert into {} ({}) values {} returning *;"
+    _bulk_update_string = "update {0} set {1} from (values {2}) as v ({3}) where {0}.{4} = v.{4}{5} returning {0}.*;"
+    _column_types_query = ("select attrelid, attname, format_type(atttypid, atttypmod) from pg_attribute "
+                           "where attrelid = %s::regclass and attnum > 0 and not attisdropped;")
     _update_string = "update {} set ({}) = ({}) where ({}) returning *;"
-    _select_all_string_with_condition = "select * from {} where ({}) order by {} limit {} offset {};"
-    _select_all_string = "select * from {} order by {} limit {} offset {};"
-    _select_selective_column = "select {} from {} order by {} limit {} offset {};"
-    _select_selective_column_with_condition = "select {} from {} where ({}) order by {} limit {} offset {};"
+    _select_string = "select {} from {}"
+    _select_where = " where ({})"
+    _select_order_by = " order by {} limit %s offset %s;"
     _delete_query = "delete from {} where ({});"
     _count_query = "select count(*) from {};"
     _count_query_where = "select count(*) from {} where {};"
+    _declare_cursor = "declare {} no scroll cursor for {}"
+    _fetch_cursor = "fetch forward {} from {};"
+    _prepare_string = "prepare {} as {}"
+    _execute_string = "execute {}({})"
+    _PREPARABLE_OPS = frozenset(('=', '!=', '<>', '<', '>', '<=', '>=', 'like', 'ilike', 'not like', 'not ilike',
+                                 '= any'))
     _OR = ' or '
     _AND = ' and '
     _LPAREN = '('
     _RPAREN = ')'
     _WHERE_AND = '{} {} %s'
+    _WHERE_ANY = '{} = any(%s)'
+    _EQ_ANY = '= any'
     _PLACEHOLDER = ' %s,'
     _COMMA = ', '
 
     @classmethod
     def connect(cls, database: str, user: str, password: str, host: str, port: int, *, use_pool: bool=True,
                 enable_ssl: bool=False, minsize=1, maxsize=50, keepalives_idle=5, keepalives_interval=4, echo=False,
-                **kwargs):
+                prepare_statements: bool=False, preallocate: bool=False, **kwargs):
         """
         Sets connection parameters
         For more information on the parameters that is accepts,
         see : http://www.postgresql.org/docs/9.2/static/libpq-connect.html
+
+        With prepare_statements, count, insert, update, delete and select prepare their query once per connection
+        and then only send EXECUTE, so the server skips parsing and planning on repeated calls.
+        Where clauses using operators that do not take a plain value, such as in or is, are executed as usual.
+        Prepared statements belong to a server session, so this does not work behind pgbouncer in transaction
+        pooling mode, and without use_pool every call pays for both PREPARE and EXECUTE with no reuse
+
+        With preallocate, the pool opens all maxsize connections when it is created instead of growing on demand,
+        so no request pays for a connection handshake; combine it with warm_up to do this at startup
         """
         cls._connection_params['database'] = database
         cls._connection_params['user'] = user
@@ -141,13 +224,14 @@ class PostgresStore:
         cls._connection_params['host'] = host
         cls._connection_params['port'] = port
         cls._connection_params['sslmode'] = 'prefer' if enable_ssl else 'disable'
-        cls._connection_params['minsize'] = minsize
+        cls._connection_params['minsize'] = maxsize if preallocate else minsize
         cls._connection_params['maxsize'] = maxsize
         cls._connection_params['keepalives_idle'] = keepalives_idle
         cls._connection_params['keepalives_interval'] = keepalives_interval
         cls._connection_params['echo'] = echo
         cls._connection_params.update(kwargs)
         cls._use_pool = use_pool
+        cls._prepare_statements = prepare_statements
 
     @classmethod
     def use_pool(cls, pool: Pool):
@@ -155,39 +239,56 @@ class PostgresStore:
         Sets an existing connection pool instead of using connect() to make one
         """
         cls._pool = pool
+        cls._use_pool = True
 
     @classmethod
-    @coroutine
-    def get_pool(cls) -> Pool:
+    async def get_pool(cls) -> Pool:
         """
         Yields:
             existing db connection pool
         """
+        pool = cls._pool
+        if pool is None:
+            pool = await cls._create_pool()
+        return pool
+
+    @classmethod
+    async def _create_pool(cls) -> Pool:
         if len(cls._connection_params) < 5:
             raise ConnectionError('Please call SQLStore.connect before calling this method')
-        if not cls._pool:
-            cls._pool = yield from create_pool(**cls._connection_params)
+        # created lazily so the lock binds to the loop that is actually running
+        if cls._pool_lock is None:
+            cls._pool_lock = asyncio.Lock()
+        async with cls._pool_lock:
+            if cls._pool is None:
+                cls._pool = await create_pool(**cls._connection_params)
         return cls._pool
 
     @classmethod
-    @coroutine
-    def get_cursor(cls, cursor_type=_CursorType.PLAIN) -> Cursor:
+    async def warm_up(cls):
+        """
+        Creates the connection pool ahead of the first query
+
+        aiopg opens `minsize` connections while creating the pool, so calling this at startup
+        moves the connect and authentication cost off the first requests, for every connection with preallocate
+        """
+        if cls._use_pool:
+            await cls.get_pool()
+
+    @classmethod
+    async def get_cursor(cls, cursor_type=_CursorType.PLAIN) -> Cursor:
         """
         Yields:
             new client-side cursor from existing db connection pool
         """
-        _cur = None
         if cls._use_pool:
-            _connection_source = yield from cls.get_pool()
+            _connection_source = cls._pool
+            if _connection_source is None:
+                _connection_source = await cls._create_pool()
         else:
-            _connection_source = yield from aiopg.connect(echo=False, **cls._connection_params)
+            _connection_source = await aiopg.connect(echo=False, **cls._connection_params)
 
-        if cursor_type == _CursorType.PLAIN:
-            _cur = yield from _connection_source.cursor()
-        if cursor_type == _CursorType.NAMEDTUPLE:
-            _cur = yield from _connection_source.cursor(cursor_factory=psycopg2.extras.NamedTupleCursor)
-        if cursor_type == _CursorType.DICT:
-            _cur = yield from _connection_source.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        _cur = await _connection_source.cursor(cursor_factory=_CURSOR_FACTORIES[cursor_type])
 
         if not cls._use_pool:
             _cur = cursor_context_manager(_connection_source, _cur)
@@ -195,9 +296,62 @@ class PostgresStore:
         return _cur
 
     @classmethod
-    @coroutine
-    @cursor
-    def count(cls, cur, table:str, where_keys: list=None):
+    async def pipeline(cls, *operations):
+        """
+        Runs independent queries concurrently instead of one after the other
+
+        Each operation acquires its own cursor, so with a pool the round-trips overlap on separate connections.
+        The operations must not depend on each other and do not share a transaction.
+
+        Args:
+            operations: coroutines of store operations, e.g. cls.select('users', 'id'), cls.count('users')
+
+        Returns:
+            A list with the result of each operation in the order they were given
+
+        """
+        return await asyncio.gather(*operations)
+
+    @classmethod
+    async def _execute(cls, cur, query, values, where_shape=None):
+        """
+        Executes a query built by the store, through a prepared statement when prepare_statements is set
+
+        Statements are prepared lazily, the first time a connection runs a given query,
+        and are forgotten along with the connection when it is closed
+        """
+        if not cls._prepare_statements or not cls._can_prepare(where_shape):
+            return await cur.execute(query, values)
+        name, prepare, execute = cls._get_prepared_statement(query)
+        conn = cur._impl.connection
+        prepared = cls._prepared.get(conn)
+        if prepared is None:
+            prepared = cls._prepared[conn] = set()
+        if name not in prepared:
+            await cur.execute(prepare)
+            prepared.add(name)
+        return await cur.execute(execute, values)
+
+    @classmethod
+    @lru_cache(maxsize=1024)
+    def _can_prepare(cls, where_shape):
+        # operators like in and is take a list or a keyword on their right, which a $n parameter cannot stand for
+        return not where_shape or all(op.strip().lower() in cls._PREPARABLE_OPS for ele in where_shape for _, op in ele)
+
+    @classmethod
+    @lru_cache(maxsize=1024)
+    def _get_prepared_statement(cls, query):
+        # PREPARE takes numbered $n parameters, EXECUTE passes the values positionally with the usual %s
+        parts = query.rstrip(';').split('%s')
+        count = len(parts) - 1
+        body = parts[0] + ''.join('${}{}'.format(i, part) for i, part in enumerate(parts[1:], 1))
+        # derived from the text so a query evicted from this cache maps back to the statement already prepared
+        name = 'cauldron_' + sha1(query.encode()).hexdigest()
+        execute = cls._execute_string.format(name, (cls._PLACEHOLDER * count)[:-1]) if count else 'execute ' + name
+        return name, cls._prepare_string.format(name, body), execute
+
+    @classmethod
+    async def count(cls, table:str, where_keys: list=None):
         """
         gives the number of records in the table
 
@@ -208,43 +362,93 @@ class PostgresStore:
             an integer indicating the number of records in the table
 
         """
-
         if where_keys:
-            where_clause, values = cls._get_where_clause_with_values(where_keys)
-            query = cls._count_query_where.format(table, where_clause)
-            q, t = query, values
+            where_shape, t = cls._get_where_shape_with_values(where_keys)
+            q = cls._get_count_query(table, where_shape)
         else:
-            query = cls._count_query.format(table)
-            q, t = query, ()
-        yield from cur.execute(q, t)
-        result = yield from cur.fetchone()
+            where_shape, t = None, ()
+            q = cls._get_count_query(table, None)
+        with (await cls.get_cursor()) as cur:
+            await cls._execute(cur, q, t, where_shape)
+            result = await cur.fetchone()
         return int(result[0])
 
     @classmethod
-    @coroutine
-    @nt_cursor
-    def insert(cls, cur, table: str, values: dict):
+    async def insert(cls, table: str, values: dict, returning: bool=True):
         """
         Creates an insert statement with only chosen fields
 
         Args:
             table: a string indicating the name of the table
             values: a dict of fields and values to be inserted
+            returning: whether to send the inserted row back, skipping it saves encoding and fetching the row
+
+        Returns:
+            A 'Record' object with table columns as properties, or the number of rows inserted if returning is False
+
+        """
+        query = cls._get_insert_query(table, tuple(values), returning)
+        with (await cls.get_cursor(_CursorType.NAMEDTUPLE)) as cur:
+            await cls._execute(cur, query, list(values.values()))
+            if not returning:
+                return cur.rowcount
+            return await cur.fetchone()
+
+    @classmethod
+    async def bulk_insert(cls, table: str, records: list, page_size: int=1000):
+        """
+        Inserts many records using one multi-row insert statement per page of records
+        When the records span more than one page, the pages run in a single transaction,
+        so either every record is inserted or none is
+
+        Args:
+            table: a string indicating the name of the table
+            records: a list of dicts of fields and values to be inserted, all with the same fields
+            page_size: the maximum number of records sent in a single statement
 
         Returns:
-            A 'Record' object with table columns as properties
+            A list of 'Record' objects with table columns as properties
 
         """
-        keys = cls._COMMA.join(values.keys())
-        value_place_holder = cls._PLACEHOLDER * len(values)
-        query = cls._insert_string.format(table, keys, value_place_holder[:-1])
-        yield from cur.execute(query, tuple(values.values()))
-        return (yield from cur.fetchone())
+        if not records:
+            return []
+        keys = tuple(records[0])
+        columns, row_place_holder = cls._get_bulk_insert_parts(keys)
+        getter = itemgetter(*keys)
+
+        def pages():
+            for start in range(0, len(records), page_size):
+                page = records[start:start + page_size]
+                yield (cls._bulk_insert_string.format(table, columns, cls._COMMA.join([row_place_holder] * len(page))),
+                       cls._flatten_rows(map(getter, page), len(keys)))
+
+        with (await cls.get_cursor(_CursorType.NAMEDTUPLE)) as cur:
+            return await cls._execute_pages(cur, pages(), len(records) > page_size)
+
+    @staticmethod
+    async def _execute_pages(cur, pages, atomic):
+        """
+        Runs the (query, values) pages of a bulk statement on cur and collects the rows they return
+
+        With atomic the pages run in one transaction, BEGIN going out with the first page,
+        so a page that fails, or a record that cannot be read, does not leave the earlier pages applied
+        """
+        lazy_begin = _LazyBegin(cur) if atomic else None
+        result = []
+        try:
+            for query, values in pages:
+                await cur.execute(query, values)
+                result.extend(await cur.fetchall())
+        except BaseException:
+            if lazy_begin is not None and lazy_begin.restore():
+                await cur.execute('ROLLBACK')
+            raise
+        if lazy_begin is not None and lazy_begin.restore():
+            await cur.execute('COMMIT')
+        return result
 
     @classmethod
-    @coroutine
-    @nt_cursor
-    def update(cls, cur, table: str, values: dict, where_keys: list) -> tuple:
+    async def update(cls, table: str, values: dict, where_keys: list) -> tuple:
         """
         Creates an update query with only chosen fields
         Supports only a single field where clause
@@ -261,28 +465,169 @@ class PostgresStore:
             an integer indicating count of rows deleted
 
         """
-        keys = cls._COMMA.join(values.keys())
-        value_place_holder = cls._PLACEHOLDER * len(values)
-        where_clause, where_values = cls._get_where_clause_with_values(where_keys)
-        query = cls._update_string.format(table, keys, value_place_holder[:-1], where_clause)
-        yield from cur.execute(query, (tuple(values.values()) + where_values))
-        return (yield from cur.fetchall())
+        where_shape, where_values = cls._get_where_shape_with_values(where_keys)
+        query = cls._get_update_query(table, tuple(values), where_shape)
+        params = list(values.values())
+        params.extend(where_values)
+        with (await cls.get_cursor(_CursorType.NAMEDTUPLE)) as cur:
+            await cls._execute(cur, query, params, where_shape)
+            return await cur.fetchall()
 
     @classmethod
-    def _get_where_clause_with_values(cls, where_keys):
-        values = []
+    async def bulk_update(cls, table: str, records: list, key: str, page_size: int=1000):
+        """
+        Updates many rows using one update statement per page of records instead of one per row
+        Rows are matched on the key column and every other field of a record is set on the matching row
+        When the records span more than one page, the pages run in a single transaction,
+        so either every record is applied or none is
 
-        def make_and_query(ele: dict):
-            and_query = cls._AND.join([cls._WHERE_AND.format(e[0], e[1][0]) for e in ele.items()])
-            values.extend([val[1] for val in ele.values()])
-            return cls._LPAREN + and_query + cls._RPAREN
+        Args:
+            table: a string indicating the name of the table
+            records: a list of dicts of fields and values, all with the same fields including key
+            key: the column used to match a record to a row, usually the primary key
+            page_size: the maximum number of records sent in a single statement
 
-        return cls._OR.join(map(make_and_query, where_keys)), tuple(values)
+        Returns:
+            A list of 'Record' objects for the updated rows
+
+        """
+        if not records:
+            return []
+        keys = tuple(records[0])
+        if key not in keys or len(keys) < 2:
+            raise ValueError('bulk_update records need the key and at least one field to set')
+        getter = itemgetter(*keys)
+
+        def pages():
+            for start in range(0, len(records), page_size):
+                page = records[start:start + page_size]
+                yield (query.format(cls._COMMA.join([row_place_holder] * len(page))),
+                       cls._flatten_rows(map(getter, page), len(keys)))
+
+        with (await cls.get_cursor(_CursorType.NAMEDTUPLE)) as cur:
+            column_types = await cls._get_column_types(cur, table, keys)
+            query, row_place_holder = cls._get_bulk_update_parts(table, keys, key,
+                                                                 tuple(column_types.get(k) for k in keys))
+            try:
+                return await cls._execute_pages(cur, pages(), len(records) > page_size)
+            except Exception:
+                # the cached types may be stale, e.g. after an alter table, so the next call looks them up again
+                cls._table_oids.pop((cls, table), None)
+                raise
+
+    @staticmethod
+    def _get_where_shape_with_values(where_keys):
+        """
+        Splits where_keys in a single pass into the values and a hashable shape
+        that keeps the columns and operators but drops the values
+        """
+        shape, values = [], []
+        for ele in where_keys:
+            and_shape = []
+            for key, val in ele.items():
+                and_shape.append((key, val[0]))
+                values.append(val[1])
+            shape.append(tuple(and_shape))
+        return tuple(shape), tuple(values)
 
     @classmethod
-    @coroutine
-    @cursor
-    def delete(cls, cur, table: str, where_keys: list):
+    @lru_cache(maxsize=1024)
+    def _get_where_clause(cls, where_shape):
+        and_queries = []
+        for ele in where_shape:
+            and_query = cls._AND.join([cls._WHERE_ANY.format(key) if op == cls._EQ_ANY
+                                       else cls._WHERE_AND.format(key, op) for key, op in ele])
+            and_queries.append(cls._LPAREN + and_query + cls._RPAREN)
+        return cls._OR.join(and_queries)
+
+    # The query builders below only depend on the shape of a call (table, columns, where columns and operators),
+    # never on the values, so each distinct shape is formatted once and every later call is a cache lookup.
+    # Keeping the sql text stable also lets the server reuse its cached plans.
+
+    @classmethod
+    @lru_cache(maxsize=1024)
+    def _get_count_query(cls, table, where_shape):
+        if where_shape:
+            return cls._count_query_where.format(table, cls._get_where_clause(where_shape))
+        return cls._count_query.format(table)
+
+    @classmethod
+    @lru_cache(maxsize=1024)
+    def _get_insert_query(cls, table, keys, returning=True):
+        template = cls._insert_string if returning else cls._insert_string_no_returning
+        value_place_holder = cls._PLACEHOLDER * len(keys)
+        return template.format(table, cls._COMMA.join(keys), value_place_holder[:-1])
+
+    @classmethod
+    @lru_cache(maxsize=1024)
+    def _get_bulk_insert_parts(cls, keys):
+        value_place_holder = cls._PLACEHOLDER * len(keys)
+        return cls._COMMA.join(keys), cls._LPAREN + value_place_holder[:-1] + cls._RPAREN
+
+    @classmethod
+    @lru_cache(maxsize=1024)
+    def _get_bulk_update_parts(cls, table, keys, key, types):
+        # the columns of a values list are untyped and resolve to text, so each one is cast to its column's type
+        casts = {k: '::' + t if t else '' for k, t in zip(keys, types)}
+        set_clause = cls._COMMA.join('{0} = v.{0}{1}'.format(k, casts[k]) for k in keys if k != key)
+        columns, row_place_holder = cls._get_bulk_insert_parts(keys)
+        return cls._bulk_update_string.format(table, set_clause, '{}', columns, key, casts[key]), row_place_holder
+
+    @classmethod
+    async def _get_column_types(cls, cur, table, keys):
+        """
+        Maps the columns of a table to their sql types
+
+        Cached per class and per table oid, so the same table reached through different names shares an entry.
+        Looked up again when keys has a column the cached mapping does not know
+        """
+        oid = cls._table_oids.get((cls, table))
+        column_types = cls._column_types.get((cls, oid))
+        if column_types is None or not all(k in column_types for k in keys):
+            await cur.execute(cls._column_types_query, (table,))
+            rows = await cur.fetchall()
+            oid = rows[0][0] if rows else None
+            column_types = {name: sql_type for _, name, sql_type in rows}
+            cls._table_oids[(cls, table)] = oid
+            cls._column_types[(cls, oid)] = column_types
+        return column_types
+
+    @classmethod
+    def clear_column_types(cls):
+        """
+        Forgets the column types bulk_update has looked up, e.g. after altering a table
+        """
+        for cache in (cls._table_oids, cls._column_types):
+            for key in [k for k in cache if k[0] is cls]:
+                del cache[key]
+
+    @staticmethod
+    def _flatten_rows(rows, width):
+        # itemgetter returns a bare value rather than a tuple when it has a single key
+        return list(rows) if width == 1 else list(chain.from_iterable(rows))
+
+    @classmethod
+    @lru_cache(maxsize=1024)
+    def _get_update_query(cls, table, keys, where_shape):
+        value_place_holder = cls._PLACEHOLDER * len(keys)
+        return cls._update_string.format(table, cls._COMMA.join(keys), value_place_holder[:-1],
+                                         cls._get_where_clause(where_shape))
+
+    @classmethod
+    @lru_cache(maxsize=1024)
+    def _get_delete_query(cls, table, where_shape):
+        return cls._delete_query.format(table, cls._get_where_clause(where_shape))
+
+    @classmethod
+    @lru_cache(maxsize=1024)
+    def _get_select_query(cls, table, order_by, columns, where_shape):
+        query = cls._select_string.format(cls._COMMA.join(columns) if columns else '*', table)
+        if where_shape:
+            query += cls._select_where.format(cls._get_where_clause(where_shape))
+        return query + cls._select_order_by.format(order_by)
+
+    @classmethod
+    async def delete(cls, table: str, where_keys: list):
         """
         Creates a delete query with where keys
         Supports multiple where clause with and or or both
@@ -298,16 +643,15 @@ class PostgresStore:
             an integer indicating count of rows deleted
 
         """
-        where_clause, values = cls._get_where_clause_with_values(where_keys)
-        query = cls._delete_query.format(table, where_clause)
-        yield from cur.execute(query, values)
-        return cur.rowcount
+        where_shape, values = cls._get_where_shape_with_values(where_keys)
+        query = cls._get_delete_query(table, where_shape)
+        with (await cls.get_cursor()) as cur:
+            await cls._execute(cur, query, values, where_shape)
+            return cur.rowcount
 
     @classmethod
-    @coroutine
-    @nt_cursor
-    def select(cls, cur, table: str, order_by: str, columns: list=None, where_keys: list=None, limit=100,
-               offset=0):
+    async def select(cls, table: str, order_by: str, columns: list=None, where_keys: list=None, limit=100,
+                     offset=0):
         """
         Creates a select query for selective columns with where keys
         Supports multiple where claus with and or or both
@@ -323,37 +667,125 @@ class PostgresStore:
             example of where keys: [{'name':('>', 'cip'),'url':('=', 'cip.com'},{'type':{'<=', 'manufacturer'}}]
             where_clause will look like ((name>%s and url=%s) or (type <= %s))
             items within each dictionary get 'AND'-ed and across dictionaries get 'OR'-ed
+            {'id': ('= any', [1, 2, 3])} matches any of the listed values with a single array parameter,
+            the list elements must adapt to the column's type (e.g. UUID objects for a uuid column)
 
         Returns:
             A list of 'Record' object with table columns as properties
 
         """
-        if columns:
-            columns_string = cls._COMMA.join(columns)
-            if where_keys:
-                where_clause, values = cls._get_where_clause_with_values(where_keys)
-                query = cls._select_selective_column_with_condition.format(columns_string, table, where_clause,
-                                                                           order_by, limit, offset)
-                q, t = query, values
-            else:
-                query = cls._select_selective_column.format(columns_string, table, order_by, limit, offset)
-                q, t = query, ()
+        if where_keys:
+            where_shape, t = cls._get_where_shape_with_values(where_keys)
+            q = cls._get_select_query(table, order_by, tuple(columns or ()), where_shape)
+            t += (limit, offset)
         else:
-            if where_keys:
-                where_clause, values = cls._get_where_clause_with_values(where_keys)
-                query = cls._select_all_string_with_condition.format(table, where_clause, order_by, limit, offset)
-                q, t = query, values
-            else:
-                query = cls._select_all_string.format(table, order_by, limit, offset)
-                q, t = query, ()
+            where_shape = None
+            q = cls._get_select_query(table, order_by, tuple(columns or ()), None)
+            t = (limit, offset)
+
+        with (await cls.get_cursor(_CursorType.NAMEDTUPLE)) as cur:
+            await cls._execute(cur, q, t, where_shape)
+            return await cur.fetchall()
+
+    @classmethod
+    async def select_coalesced(cls, table: str, order_by: str, columns: list=None, where_keys: list=None, limit=100,
+                               offset=0):
+        """
+        Same as select, but concurrent calls with identical arguments share a single query
+
+        Useful against stampedes of the same read, e.g. after a cache miss. Every caller receives
+        the same list of records, so it must not be mutated. Calls whose where values are not
+        hashable fall back to a plain select.
 
-        yield from cur.execute(q, t)
-        return (yield from cur.fetchall())
+        Returns:
+            A list of 'Record' object with table columns as properties
+
+        """
+        if where_keys:
+            where_shape, values = cls._get_where_shape_with_values(where_keys)
+        else:
+            where_shape, values = None, ()
+        # '= any' values are lists, which are not hashable
+        values = tuple(tuple(v) if isinstance(v, list) else v for v in values)
+        key = (asyncio.get_event_loop(), cls, table, order_by, tuple(columns or ()), where_shape, values, limit, offset)
+        try:
+            future = cls._inflight_selects.get(key)
+        except TypeError:
+            return await cls.select(table, order_by, columns, where_keys, limit, offset)
+        if future is None:
+            future = asyncio.ensure_future(cls.select(table, order_by, columns, where_keys, limit, offset))
+            cls._inflight_selects[key] = future
+            future.add_done_callback(lambda _: cls._inflight_selects.pop(key, None))
+        # a cancelled caller must not cancel the query the other callers are waiting on
+        return await asyncio.shield(future)
+
+    @classmethod
+    def iter_select(cls, table: str, order_by: str, columns: list=None, where_keys: list=None, page_size: int=500):
+        """
+        Streams the rows of a select query instead of loading the whole result set into memory
+
+        Rows are read through a server-side cursor page_size rows at a time, so memory stays bounded
+        and the first rows are available before the query has been fully read.
+        The cursor lives in a transaction that holds its connection until iteration ends.
+
+        Args:
+            table: a string indicating the name of the table
+            order_by: a string indicating column name to order the results on
+            columns: list of columns to select from
+            where_keys: list of dictionary, same format as in select
+            page_size: the number of rows fetched from the server at a time
+
+        Yields:
+            'Record' objects with table columns as properties
+
+        """
+        if where_keys:
+            where_shape, values = cls._get_where_shape_with_values(where_keys)
+            query = cls._get_select_query(table, order_by, tuple(columns or ()), where_shape)
+            values += (None, 0)
+        else:
+            query = cls._get_select_query(table, order_by, tuple(columns or ()), None)
+            values = (None, 0)
+        return cls._iter_query(query.rstrip(';'), values, page_size)
+
+    @classmethod
+    def iter_raw_sql(cls, query: str, values: tuple, page_size: int=500):
+        """
+        Streams the rows of a raw sql query, same as iter_select
+
+        Args:
+            query : a single select query to execute
+            values : tuple of values to be used with the query
+            page_size: the number of rows fetched from the server at a time
+
+        Yields:
+            result rows as named tuples
+
+        """
+        return cls._iter_query(query.rstrip().rstrip(';'), values, page_size)
+
+    @classmethod
+    async def _iter_query(cls, query, values, page_size):
+        # aiopg connections are asynchronous and psycopg2 cannot open named cursors on them,
+        # so the portal is declared in sql instead
+        name = 'cauldron_' + uuid4().hex
+        fetch = cls._fetch_cursor.format(page_size, name)
+        with (await cls.get_cursor(_CursorType.NAMEDTUPLE)) as cur:
+            await cur.execute('BEGIN')
+            try:
+                await cur.execute(cls._declare_cursor.format(name, query), values)
+                while True:
+                    await cur.execute(fetch)
+                    rows = await cur.fetchall()
+                    if not rows:
+                        break
+                    for row in rows:
+                        yield row
+            finally:
+                await cur.execute('COMMIT')
 
     @classmethod
-    @coroutine
-    @nt_cursor
-    def raw_sql(cls, cur, query: str, values: tuple):
+    async def raw_sql(cls, query: str, values: tuple):
         """
         Run a raw sql query
 
@@ -365,8 +797,9 @@ class PostgresStore:
             result of query as list of named tuple
 
         """
-        yield from cur.execute(query, values)
-        return (yield from cur.fetchall())
+        with (await cls.get_cursor(_CursorType.NAMEDTUPLE)) as cur:
+            await cur.execute(query, values)
+            return await cur.fetchall()
 
 
 @contextmanager
@@ -6,4 +6,5 @@ setup(name='cauldron',
       author_email='ankitchandawala@gmail.com',
       url='https://github.com/nerandell/cauldron',
       description='Utils to reduce boilerplate code',
-      packages=['cauldron'], install_requires=['aiopg', 'aioredis', 'psycopg2'])
+      python_requires='>=3.6',
+      packages=['cauldron'], install_requires=['aiopg', 'aioredis<1.0', 'hiredis', 'psycopg2>=2.8'])